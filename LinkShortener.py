@@ -1,20 +1,66 @@
-from flask import Flask, redirect, render_template, request
-import random, sqlite3, os, validators, time
+from flask import Flask, Response, render_template, request
+import random, sqlite3, os, validators, time, collections, threading, atexit, queue, urllib.parse, contextlib, string
 app = Flask(__name__)
 
 '''
 This application has the following dependencies:
     - Flask
     - validators
+    - gunicorn and gevent (production deployment only)
+
+Running LinkShortener.py directly starts Flask's development server. In production, serve wsgi.py with a
+WSGI server instead, e.g.:
+    gunicorn -k gevent -w 1 --worker-connections=1000 wsgi:app
+A single worker process is used because the link map and the click buffer live in process memory.
 '''
 
 #Application Variables
 
 APP_URL = "127.0.0.1:5000"
+app.jinja_env.globals['app_url'] = APP_URL
 FILENAME = 'database.sqlite3'
 WORKING_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
 
-database_connection = None
+CLICK_FLUSH_INTERVAL = 2 #seconds between writes of buffered click counts
+CLOCK_UPDATE_INTERVAL = 0.25 #seconds between refreshes of cached_epoch_time
+SHORT_LINK_BATCH_SIZE = 32 #candidate codes checked against the database per query
+SHORT_LINK_MAX_FAILED_BATCHES = 1 #fully taken candidate batches tolerated at one length before trying longer codes
+DATABASE_POOL_SIZE = 8 #number of read-only database connections shared between request threads
+CHARSET = "abcdefghjkmnopqrstuvwxyzABCDEFGHJKLMNPQRSTUVWXYZ23456789" #valid characters for short-codes, excludes ones that look to similar (i.e. 1,l,i, 0,O etc.)
+
+#characters the fast URL check accepts without handing off to validators; anything else gets the full validation
+HOST_NAME_CHARACTERS = frozenset(string.ascii_lowercase + string.digits + "-.")
+URL_PATH_CHARACTERS = frozenset(string.ascii_letters + string.digits + "-._~/!$'()*+,:=@%")
+
+#body sent with every redirect; unlike werkzeug's redirect() it doesn't repeat the target URL, so it never changes
+REDIRECT_BODY = (b"<!doctype html>\n"
+                 b"<html lang=en>\n"
+                 b"<title>Redirecting...</title>\n"
+                 b"<h1>Redirecting...</h1>\n"
+                 b"<p>You should be redirected automatically to the target URL.\n")
+
+#sqlite allows a single writer at a time, so queries that still need sqlite borrow a connection from a pool
+#(see read_database) and every write goes through one dedicated connection, serialized by write_lock
+read_pool = None
+write_database = None
+write_lock = threading.Lock()
+
+click_buffer = collections.Counter()
+click_buffer_lock = threading.Lock()
+
+cached_epoch_time = [int(time.time())] #whole-second clock shared by requests, refreshed by a background thread
+
+static_pages = {} #rendered html of pages whose content never changes, keyed by template and context
+
+#SQL Statements
+#kept as constants so every call hands sqlite the exact same text and hits its prepared statement cache
+
+SQL_GET = "select short_link, url, deletion_id, clicks, timestamp from links where short_link = ?"
+SQL_GET_ALL_LINKS = "select short_link, url, deletion_id from links"
+SQL_FIND_EXISTING = "select short_link from links where short_link in ({0})".format(",".join("?" * SHORT_LINK_BATCH_SIZE))
+SQL_INSERT = "insert into links (url, short_link, deletion_id, clicks, timestamp) values (?, ?, ?, ?, ?)"
+SQL_DELETE = "delete from links where short_link = ?"
+SQL_ADD_CLICKS = "update links set clicks = clicks + ? where short_link = ?"
 
 #Helper Methods
 
@@ -24,8 +70,59 @@ def generate_random_code(length: int) -> str:
     :param length: Length of the desired code
     :return: The random code.
     '''
-    charset="abcdefghjkmnopqrstuvwxyzABCDEFGHJKLMNPQRSTUVWXYZ23456789" #valid characters for short-codes, excludes ones that look to similar (i.e. 1,l,i, 0,O etc.)
-    return "".join([charset[random.randint(0, len(charset)-1)] for x in range(length)])
+    return "".join(random.choices(CHARSET, k=length))
+
+def generate_random_codes(length: int, count: int) -> list:
+    '''
+    Generates several n-digit random codes, drawing all of the characters in a single call
+    :param length: Length of each code
+    :param count: How many codes to generate
+    :return: A list of random codes.
+    '''
+    characters = "".join(random.choices(CHARSET, k=length * count))
+    return [characters[i:i + length] for i in range(0, length * count, length)]
+
+def is_simple_http_url(url: str) -> bool:
+    '''
+    Cheaply checks whether a string is an ordinary http(s) URL with a plain domain name, without running the
+    validators regexes. It only answers True for URLs that validators.url also accepts; anything unusual (IP
+    addresses, user info, odd characters or query strings) gets False so the caller falls back to validators.
+    :param url: string of the URL to check
+    :return: True if the URL is plainly valid, False if it needs a full validation
+    '''
+    if not url.startswith(("http://", "https://")) or url.endswith(("?", "#")):
+        return False
+    #urlsplit silently drops tabs and newlines, so they have to be rejected before it runs
+    if any(character.isspace() for character in url):
+        return False
+
+    try:
+        parts = urllib.parse.urlsplit(url)
+        port = parts.port #raises ValueError on a malformed port
+    except ValueError:
+        return False
+
+    host = parts.hostname
+    if host is None or len(host) > 253 or not set(host) <= HOST_NAME_CHARACTERS:
+        return False
+    if parts.netloc.lower() not in (host, "{0}:{1}".format(host, port)) or port == 0:
+        return False
+
+    labels = host.split(".")
+    if len(labels) < 2 or not labels[-1].isalpha() or len(labels[-1]) < 2:
+        return False
+    for label in labels:
+        if not 0 < len(label) <= 63 or label.startswith("-") or label.endswith("-"):
+            return False
+
+    if not set(parts.path + parts.fragment) <= URL_PATH_CHARACTERS:
+        return False
+    if parts.query:
+        for parameter in parts.query.split("&"):
+            if "=" not in parameter or not set(parameter) <= URL_PATH_CHARACTERS:
+                return False
+
+    return True
 
 def format_url(url: str) -> str:
     '''
@@ -33,6 +130,13 @@ def format_url(url: str) -> str:
     :param url: string of the URL to validate
     :return: a valid URL, or -1 if the URL could not be formatted
     '''
+    url = url.strip()
+
+    if is_simple_http_url(url):
+        return url
+    elif "://" not in url and is_simple_http_url("http://" + url):
+        return "http://" + url
+
     if validators.url(url):
         return url
     elif validators.domain(url):
@@ -41,9 +145,75 @@ def format_url(url: str) -> str:
 
     return -1
 
+def render_static_page(template_name: str, **context) -> str:
+    '''
+    Renders a page that has no per-request content the first time it is needed and serves the cached html afterwards
+    :param template_name: Name of the template to render
+    :param context: Template variables, which must be the same on every request
+    :return: The rendered html
+    '''
+    key = (template_name, tuple(sorted(context.items())))
+    page = static_pages.get(key)
+    if page is None:
+        page = static_pages[key] = render_template(template_name, **context)
+    return page
+
+def flush_click_buffer():
+    '''
+    Writes the buffered click counts to the database in a single transaction. If the write fails the counts are
+    put back into the buffer, so the next flush retries them.
+    :return: None
+    '''
+    global click_buffer
+
+    if write_database is None:
+        return
+
+    #the snapshot is taken under write_lock so a link deleted (and its code reused) after the snapshot can't be
+    #credited with the deleted link's clicks
+    with write_lock:
+        with click_buffer_lock:
+            snapshot, click_buffer = click_buffer, collections.Counter()
+
+        if not snapshot:
+            return
+
+        try:
+            with write_database.transaction():
+                write_database.add_clicks(snapshot)
+        except Exception:
+            with click_buffer_lock:
+                click_buffer.update(snapshot)
+            raise
+
+def schedule_click_flush():
+    '''
+    Flushes the click buffer and re-arms a timer to do so again after CLICK_FLUSH_INTERVAL seconds
+    :return: None
+    '''
+    try:
+        flush_click_buffer()
+    except Exception:
+        app.logger.exception("Failed to flush buffered clicks, retrying in %s seconds", CLICK_FLUSH_INTERVAL)
+    finally:
+        timer = threading.Timer(CLICK_FLUSH_INTERVAL, schedule_click_flush)
+        timer.daemon = True
+        timer.start()
+
+def update_cached_time():
+    '''
+    Keeps cached_epoch_time current; runs forever on a background thread
+    :return: None
+    '''
+    while True:
+        cached_epoch_time[0] = int(time.time())
+        time.sleep(CLOCK_UPDATE_INTERVAL)
+
 #Application Classes
 
 class Link():
+    __slots__ = ('url', 'short_link', 'deletion_id', 'clicks', 'timestamp')
+
     def __init__(self, short_link: str, url: str, deletion_id: str, clicks: int, timestamp: int):
         self.url = url
         self.short_link = short_link
@@ -55,17 +225,32 @@ class Link():
         return "[URL: {0}, SL: {1}, Deletion ID = {2}, Clicks = {3}, Timestamp = {4}]".format(self.url, self.short_link, self.deletion_id, self.clicks, self.timestamp)
 
 class LinkDatabase():
-    def __init__(self, filename: str):
+    #the whole table as short_link -> (url, deletion_id), shared by every connection to the database. Only written
+    #by committed transactions, which are already serialized by write_lock, and single dict operations are atomic
+    _links = {}
+
+    def __init__(self, filename: str, read_only: bool = False):
         """
         Initializes a new instance of the LinkDatabase class, which provides a layer of interaction between the
         application and sqlite
         :param filename: A string containing the name of the database file, stored within the same directory as LinkShortener.py
+        :param read_only: Default false; whether the connection should refuse to modify the database
         :return: None
         """
         db_path = os.path.join(WORKING_DIRECTORY, filename)
 
         self._connection = sqlite3.connect(db_path, check_same_thread=False)
-        self.cursor = self._connection.cursor()
+
+        #WAL lets readers run alongside the writer and only syncs on checkpoints, so commits are cheap
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("PRAGMA cache_size=-65536") #64MB page cache (negative values are in KiB)
+        self._connection.execute("PRAGMA temp_store=MEMORY")
+        self._connection.execute("PRAGMA busy_timeout=5000")
+        if read_only:
+            self._connection.execute("PRAGMA query_only=1")
+
+        self._pending_links = {} #short_link -> (url, deletion_id), or None if deleted, applied to _links on commit
 
     def close(self, commit_changes: bool = True):
         """
@@ -73,7 +258,6 @@ class LinkDatabase():
         :param commit_changes: Default true; whether or not to write changes to the database before exit
         :return: None
         """
-        self.cursor.close()
         if commit_changes:
             self._connection.commit()
         self._connection.close()
@@ -84,48 +268,118 @@ class LinkDatabase():
         :param short_link: Short link code
         :return: A Link object representing the row in the database
         """
-        self.cursor.execute("""
-            select * from links
-            where short_link = ?
-            """, (short_link,))
-
-        result = self.cursor.fetchone()
-        if not result == None:
-            return Link(short_link=result[0], url=result[1], deletion_id=result[2], clicks=result[3], timestamp=result[4])
-        else:
+        result = self._connection.execute(SQL_GET, (short_link,)).fetchone()
+        if result is None:
             return None
 
-    def update_link(self, link: Link):
-        self.cursor.execute("""
-            update links
-            set url=?,deletion_id=?,clicks=?,timestamp=?
-            where short_link = ?
-            """,(link.url, link.deletion_id, link.clicks, link.timestamp, link.short_link))
-        self._connection.commit()
+        return Link(short_link=result[0], url=result[1], deletion_id=result[2], clicks=result[3], timestamp=result[4])
 
+    @classmethod
+    def get_url(cls, short_link: str):
+        """
+        Returns only the destination URL of a short link code from the in-memory map, without querying the
+        database
+        :param short_link: Short link code
+        :return: The URL string, or None if the code does not exist
+        """
+        result = cls._links.get(short_link)
+        return result[0] if result is not None else None
+
+    @classmethod
+    def get_deletion_id(cls, short_link: str):
+        """
+        Returns only the deletion id of a short link code from the in-memory map, without querying the
+        database
+        :param short_link: Short link code
+        :return: The deletion id string, or None if the code does not exist
+        """
+        result = cls._links.get(short_link)
+        return result[1] if result is not None else None
+
+    @classmethod
+    def exists(cls, short_link: str) -> bool:
+        """
+        Checks whether a short link code exists, without querying the database
+        :param short_link: Short link code
+        :return: True if the code exists
+        """
+        return short_link in cls._links
+
+    def load_links(self):
+        """
+        Reads every link's url and deletion id into the in-memory map that get_url, get_deletion_id and exists
+        answer from. Must be called once at startup, before any requests are served.
+        :return: None
+        """
+        LinkDatabase._links = {row[0]: (row[1], row[2]) for row in self._connection.execute(SQL_GET_ALL_LINKS)}
 
-    def delete_link(self, link: Link):
-        self.cursor.execute("delete from links where short_link = ?",(link.short_link,))
-        self._connection.commit()
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Groups the writes made inside a with block into one transaction, committed when the block exits or rolled
+        back if it raises. delete_link, add_link and add_clicks must be called inside one.
+        :return: This LinkDatabase
+        """
+        try:
+            yield self
+        except BaseException:
+            self._connection.rollback()
+            raise
+        else:
+            try:
+                self._connection.commit()
+            except BaseException:
+                #leave the connection outside any transaction, or the next commit would include these writes
+                self._connection.rollback()
+                raise
+
+            for short_link, value in self._pending_links.items():
+                if value is None:
+                    self._links.pop(short_link, None)
+                else:
+                    self._links[short_link] = value
+        finally:
+            self._pending_links.clear()
+
+    def delete_link(self, short_link: str):
+        self._connection.execute(SQL_DELETE, (short_link,))
+        self._pending_links[short_link] = None
 
     def add_link(self, link: Link):
-        self.cursor.execute("""
-            insert into links (url, short_link, deletion_id, clicks, timestamp)
-            VALUES (?,?,?,?,?)
-            """,(link.url, link.short_link, link.deletion_id, link.clicks, link.timestamp))
-        self._connection.commit()
+        self._connection.execute(SQL_INSERT, (link.url, link.short_link, link.deletion_id, link.clicks, link.timestamp))
+        self._pending_links[link.short_link] = (link.url, link.deletion_id)
+
+    def add_clicks(self, clicks: dict):
+        """
+        Increments the click counters of several links at once
+        :param clicks: A mapping of short link codes to the number of clicks to add
+        :return: None
+        """
+        self._connection.executemany(SQL_ADD_CLICKS, [(count, short_link) for short_link, count in clicks.items()])
 
     def get_valid_short_link(self, length: int) -> str:
-        charset="abcdefghjkmnopqrstuvwxyzABCDEFGHJKLMNPQRSTUVWXYZ23456789"
+        """
+        Finds an unused short link code, checking a batch of random candidates per query. Once
+        SHORT_LINK_MAX_FAILED_BATCHES batches of one length turn out to be entirely taken the code length grows by
+        one, so a crowded namespace doesn't turn into an unbounded number of queries.
+        :param length: Minimum length of the desired code
+        :return: A short link code not present in the database
+        """
+        failed_batches = 0
 
         while True:
-            candidate = generate_random_code(length)
-            if not self.is_shortcode_in_db(candidate):
-                return candidate
+            candidates = generate_random_codes(length, SHORT_LINK_BATCH_SIZE)
+            existing = {row[0] for row in self._connection.execute(SQL_FIND_EXISTING, candidates)}
+
+            for candidate in candidates:
+                if candidate not in existing:
+                    return candidate
 
+            failed_batches += 1
+            if failed_batches >= SHORT_LINK_MAX_FAILED_BATCHES:
+                length += 1
+                failed_batches = 0
 
-    def is_shortcode_in_db(self, shortCode: str) -> bool:
-        return self.cursor.execute("select count(short_link) from links where short_link=?",(shortCode,)).fetchone()[0] > 0
 
     @staticmethod
     def create_database(filename: str):
@@ -139,93 +393,135 @@ class LinkDatabase():
 
         connection = sqlite3.connect(db_path)
         cursor = connection.cursor()
+        #without rowid stores each row inside the primary key b-tree, so a lookup by short link is a single descent
         cursor.execute("""
             create table "links" (
-            `short_link`	text unique,
+            `short_link`	text primary key,
             `url`	text,
-            `deletion_id`	text unique,
+            `deletion_id`	text,
             `clicks`	integer default 0,
-            `timestamp`	integer,
-            primary key(short_link)    --primary key to success
-        )""")
+            `timestamp`	integer
+        ) without rowid""")
+        cursor.execute("create unique index `idx_deletion` on links(`deletion_id`)")
 
         connection.commit()
         connection.close()
 
+@contextlib.contextmanager
+def read_database():
+    '''
+    Borrows a read-only connection from read_pool for the duration of a with block. Only needed by routes that
+    query sqlite; lookups by short link are answered from LinkDatabase's in-memory map without a connection.
+    :return: A read-only LinkDatabase
+    '''
+    database = read_pool.get()
+    try:
+        yield database
+    finally:
+        read_pool.put(database)
+
 @app.route('/')
 def main_page():
-    return render_template('main_page.html', app_url = APP_URL)
+    return render_static_page('main_page.html')
 
 @app.route('/', methods=['POST'])
 def handle_new_url():
     submitted_url = request.form["url_submit_field"].strip()
     formatted_url = format_url(submitted_url)
     if formatted_url == -1:
-        return render_template('response_page.html', app_url= APP_URL, response_line_1="The request could not be processed for the following reason:", response_line_2="The specified URL ({0}) is invalid.".format(submitted_url))
+        return render_template('response_page.html', response_line_1="The request could not be processed for the following reason:", response_line_2="The specified URL ({0}) is invalid.".format(submitted_url))
 
-    short_code = database_connection.get_valid_short_link(length=3)
     deletion_id = generate_random_code(6)
-    current_epoch_time = int(time.time())
+    current_epoch_time = cached_epoch_time[0]
 
-    new_link = Link(short_code,formatted_url,deletion_id,0,current_epoch_time)
+    #the short code is picked on the write connection under the lock so concurrent inserts can't claim the same one
+    with write_lock, write_database.transaction():
+        short_code = write_database.get_valid_short_link(length=3)
+        new_link = Link(short_code,formatted_url,deletion_id,0,current_epoch_time)
+        write_database.add_link(new_link)
 
-    database_connection.add_link(new_link)
-
-    return render_template('new_url_page.html', app_url = APP_URL, short_code = short_code, deletion_code=deletion_id)
+    return render_template('new_url_page.html', short_code = short_code, deletion_code=deletion_id)
 
 @app.route('/<argument>')
 @app.route('/<argument>/')
 def handle_redirect_url(argument=None):
-    if not argument is None:
-        link_object = database_connection.get_link_from_short(argument)
-        if link_object is None:
-            return render_template('response_page.html', app_url= APP_URL, response_line_1="The request could not be processed for the following reason:", response_line_2="The specified short code does not exist.")
+    url = LinkDatabase.get_url(argument) if argument is not None else None
+    if url is None:
+        return render_static_page('response_page.html', response_line_1="The request could not be processed for the following reason:", response_line_2="The specified short code does not exist.")
 
-        print(link_object)
-        link_object.clicks += 1
-        database_connection.update_link(link_object)
-        return redirect(link_object.url)
+    app.logger.debug("redirecting %s", argument)
+    with click_buffer_lock:
+        click_buffer[argument] += 1
+    response = Response(REDIRECT_BODY, status=302, mimetype='text/html')
+    response.headers['Location'] = url
+    return response
 
 @app.route('/<shortcode>/delete')
 @app.route('/<shortcode>/delete/')
 def deletion_page_request(shortcode=None):
-    if not database_connection.is_shortcode_in_db(shortcode):
-        return render_template('response_page.html', app_url = APP_URL, response_line_1="The request could not be processed for the following reason:", response_line_2="The specified short URL does not exist")
+    if not LinkDatabase.exists(shortcode):
+        return render_static_page('response_page.html', response_line_1="The request could not be processed for the following reason:", response_line_2="The specified short URL does not exist")
 
-    return render_template('deletion_page.html', app_url = APP_URL, short_code = shortcode, response_line_1="Enter your deletion code to delete a shortlink:")
+    return render_static_page('deletion_page.html', response_line_1="Enter your deletion code to delete a shortlink:")
 
 @app.route('/<shortcode>/stats')
 @app.route('/<shortcode>/stats/')
 def get_statistics_page(shortcode=None):
-    link_object = database_connection.get_link_from_short(shortcode)
+    with read_database() as database:
+        link_object = database.get_link_from_short(shortcode)
 
-    if link_object == None:
-        return render_template('response_page.html', app_url = APP_URL, response_line_1="The request could not be processed for the following reason:", response_line_2="The specified short URL does not exist")
+    if link_object is None:
+        return render_static_page('response_page.html', response_line_1="The request could not be processed for the following reason:", response_line_2="The specified short URL does not exist")
 
-    return render_template('response_page.html', app_url = APP_URL, short_code = shortcode, response_line_1="Statistics:", response_line_2="Time Created: {0}, Clicks: {1}".format(link_object.timestamp, link_object.clicks))
+    return render_template('response_page.html', short_code = shortcode, response_line_1="Statistics:", response_line_2="Time Created: {0}, Clicks: {1}".format(link_object.timestamp, link_object.clicks))
 
 @app.route('/<shortcode>/delete', methods=["POST"])
 @app.route('/<shortcode>/delete/', methods=["POST"])
 def handle_deletion_request(shortcode=None):
     deletion_code = request.form["deletion_code_field"]
-    link_object = database_connection.get_link_from_short(shortcode)
+    deletion_id = LinkDatabase.get_deletion_id(shortcode)
 
-    if link_object == None:
+    if deletion_id is None:
         return "Error processing request: the shortcode could not be found."
 
-    if deletion_code == link_object.deletion_id:
-        database_connection.delete_link(link_object)
-        return render_template('response_page.html', app_url = APP_URL, response_line_1="The link has been deleted.")
-    else:
-        return render_template('deletion_page.html', app_url = APP_URL, response_line_1="Unable to carry out request,", response_line_2="the deletion code you entered was not valid.")
+    if deletion_code != deletion_id:
+        return render_static_page('deletion_page.html', response_line_1="Unable to carry out request,", response_line_2="the deletion code you entered was not valid.")
 
+    with write_lock:
+        with write_database.transaction():
+            write_database.delete_link(shortcode)
 
-if __name__ == '__main__':
+        #drop clicks that haven't been flushed yet, or a new link given the same code would inherit them
+        with click_buffer_lock:
+            click_buffer.pop(shortcode, None)
+    return render_static_page('response_page.html', response_line_1="The link has been deleted.")
+
+
+def init_app():
+    '''
+    Opens (creating if needed) the database connections and starts the background clock and click flushing.
+    Must be called once before the application serves requests.
+    :return: None
+    '''
+    global read_pool, write_database
 
     if not os.path.exists(os.path.join(WORKING_DIRECTORY, FILENAME)):
         print("Database not found, creating '{0}' in '{1}'".format(FILENAME, WORKING_DIRECTORY))
         LinkDatabase.create_database(os.path.join(WORKING_DIRECTORY, FILENAME))
 
-    database_connection = LinkDatabase(os.path.join(WORKING_DIRECTORY, FILENAME))
+    write_database = LinkDatabase(os.path.join(WORKING_DIRECTORY, FILENAME))
+    write_database.load_links()
+
+    read_pool = queue.Queue()
+    for x in range(DATABASE_POOL_SIZE):
+        read_pool.put(LinkDatabase(os.path.join(WORKING_DIRECTORY, FILENAME), read_only=True))
+
+    threading.Thread(target=update_cached_time, daemon=True).start()
+    schedule_click_flush()
+    atexit.register(flush_click_buffer)
+
+if __name__ == '__main__':
+
+    init_app()
 
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,8 @@
+'''
+WSGI entry point for running the link shortener under a production server, e.g.:
+    gunicorn -k gevent -w 1 --worker-connections=1000 wsgi:app
+'''
+
+from LinkShortener import app, init_app
+
+init_app()